@@ -17,12 +17,18 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 """usage: gpxplot.py [action] [options] track.gpx
+       gpxplot.py { --heatmap | --index file | --similar file } [options] track.gpx ...
+       gpxplot.py --fetch dir [action] [options] URL ...
+       gpxplot.py --merge gap [action] [options] track.gpx ...
+       gpxplot.py --watch dir [action] [options] directory ...
 
 Analyze GPS track and plot elevation and velocity profiles.
 
 Features:
-	* using haversine formula to calculate distances (spherical Earth)
+	* using haversine formula to calculate distances (spherical Earth),
+	  or faster equirectangular approximation, or Vincenty's formula (WGS-84)
 	* support of multi-segment (discontinuous) tracks
+	* gzip, bzip2 and xz compressed input, zip and tar archives of tracks
 	* gnuplot support:
 		- generate plots if gnuplot.py is available
 		- generate gnuplot script if gnuplot.py is not available
@@ -38,6 +44,16 @@ Actions:
 --gprint      print gnuplot script to standard output
 --google      print Google Chart URL
 --table       print data table (default)
+--heatmap     count points of all given tracks in a raster over --bbox,
+              save it to -o imagefile (PNG or raw 32-bit counts)
+--index file  add content hashes and route fingerprints of all given tracks
+              to the index file, report duplicates
+--similar file
+              print indexed tracks which follow the same route as the given
+--out action[:E]=file
+              write output of action = { table | gprint | google | gnuplot }
+              to file; repeat to produce several outputs from one parsed
+              track; ':E' selects English units for this output
 
 Options:
 -h, --help    print this message
@@ -45,17 +61,76 @@ Options:
 -x var        plot var = { time | distance } against x-axis
 -y var        plot var = { elevation | velocity } against y-axis
 -o imagefile  save plot to image file (supported: PNG, JPG, EPS, SVG)
+--bbox lat1,lon1,lat2,lon2
+              area of the heatmap
+--grid WxH    size of the heatmap raster (800x800 by default)
+-j N          use N worker processes (one per CPU by default)
+--unique      skip files with the same content as a previous file
+--unique-in file
+              like --unique, also skip files with the same content
+              as a file in the index file (see --index)
+--archive dir
+              process every GPX file in the given archives separately,
+              write output of the action to dir; rerun to resume
+--fetch dir   download GPX files from the given URLs (-j N at a time),
+              write output of the action for every URL to dir
+--timeout sec
+              give up a download if the server does not respond
+              for sec seconds (30 by default)
+--merge gap   merge all given tracks in time order into one track, drop
+              duplicate points, start a new segment where no points were
+              recorded for gap = { 30s | 5min | 1h }
+--watch dir   keep running, write output of the action to dir for every
+              new or changed GPX file in the given directories
+--interval sec
+              look for new files every sec seconds (1 by default)
 -t tzname     use local timezone tzname (e.g. 'Europe/Moscow')
 -n N_points   reduce number of points in the plot to approximately N_points
+--resample step
+              interpolate track on a uniform grid of time or distance,
+              step = { 30s | 5min | 1h | 100m | 0.5km | 1mi | 500ft }
+--from time   skip track points recorded before time (e.g. '2008-05-01T10:30')
+--to time     skip track points recorded after time
+              (local to -t tzname, or UTC with the Z suffix)
+--dem dir     take elevations from SRTM .hgt tiles in dir
+--dem-fill    use --dem elevations only where the track has none
+--distance-model model
+              use model = { fast | haversine | ellipsoid } to calculate
+              distances (haversine by default)
+--max-memory size
+              keep track data within size bytes of memory (e.g. 512M),
+              spill the rest to a temporary file
 """
 
 import sys
+import os
 import datetime
 import getopt
+import re
+import zlib
+import bz2
+import zipfile
+import tarfile
+import StringIO
+import tempfile
+import hashlib
+import itertools
+import threading
+import heapq
+import Queue
+import httplib
+import socket
+import urlparse
+from array import array
 from string import join
-from math import sqrt,sin,cos,asin,pi,ceil
-from os.path import basename
+from math import sqrt,sin,cos,tan,asin,atan,atan2,pi,ceil,floor,isnan,isinf,log
+from bisect import bisect_left,bisect_right
+from struct import Struct,pack
+from itertools import islice
+from collections import OrderedDict
+from os.path import basename,exists,join as joinpath
 from re import sub
+from time import sleep
 
 import logging
 #logging.basicConfig(level=logging.DEBUG,format='%(levelname)s: %(message)s')
@@ -66,11 +141,51 @@ try:
 except:
 	pass
 
+# not available on every platform (e.g. Google App Engine)
+try:
+	import mmap
+except:
+	pass
+
+try:
+	import multiprocessing
+	import signal
+except:
+	pass
+
+try:
+	import lzma
+except:
+	try:
+		from backports import lzma
+	except:
+		pass
+
 GPX10='{http://www.topografix.com/GPX/1/0}'
 GPX11='{http://www.topografix.com/GPX/1/1}'
 dateformat='%Y-%m-%dT%H:%M:%SZ'
+magic_numbers=[('\x1f\x8b','gzip'),('BZh','bzip2'),('\xfd7zXZ\x00','xz')]
+chunksize=65536
+hgt_void=-32768 # no data value in SRTM tiles
+hgt_pair=Struct('>2h') # two neighbouring heights in a row
+pttags={'trkseg': 'trkpt', 'rte': 'rtept'}
+pointchunk=4096 # points processed at once
+point_size=320 # approximate memory used by one point in a list, bytes
+epoch=datetime.datetime(1970,1,1)
+nan=float('nan')
+checkpoint_name='.gpxplot-done'
+failed_name='.gpxplot-failed'
+fetch_jobs=4 # concurrent downloads
+fetch_timeout=30.0 # seconds
+merge_gap=300.0 # seconds without points to start a new segment
+watch_interval=1.0 # seconds between polls of watched directories
+geohash_alphabet='0123456789bcdefghjkmnpqrstuvwxyz'
+timeformats=['%Y-%m-%dT%H:%M:%S','%Y-%m-%d %H:%M:%S',
+		'%Y-%m-%dT%H:%M','%Y-%m-%d %H:%M','%Y-%m-%d']
 
 R=6371.0008 # Earth volumetric radius
+wgs84_a=6378.137 # WGS-84 semi-major axis
+wgs84_f=1/298.257223563 # WGS-84 flattening
 milesperkm=0.621371192
 feetperm=3.2808399
 
@@ -96,9 +211,31 @@ var_names={ 't': var_time,
 			'velocity': var_vel,
 			}
 
+step_units={ 's': (var_time,1.0),
+			'min': (var_time,60.0),
+			'h': (var_time,3600.0),
+			'm': (var_dist,0.001),
+			'km': (var_dist,1.0),
+			'mi': (var_dist,1.0/milesperkm),
+			'ft': (var_dist,0.001/feetperm),
+			}
+
+action_names={ 'g': 'gnuplot',
+			'gnuplot': 'gnuplot',
+			'gprint': 'printgnuplot',
+			'google': 'googlechart',
+			'table': 'printtable',
+			}
+
+output_extensions={ 'printtable': '.txt',
+			'printgnuplot': '.gp',
+			'googlechart': '.url',
+			}
+
 EXIT_EOPTION=1
 EXIT_EDEPENDENCY=2
 EXIT_EFORMAT=3
+EXIT_EPARTIAL=4 # some of the inputs could not be processed
 
 def haversin(theta):
 	return sin(0.5*theta)**2
@@ -112,40 +249,461 @@ def distance(p1,p2):
 	dist=2*R*asin(sqrt(h))
 	return dist
 
-def read_all_segments(trksegs,tzname=None,ns=GPX10,pttag='trkpt'):
-	trk=[]
-	for seg in trksegs:
-		s=[]
-		prev_ele,prev_time=0.0,None
-		trkpts=seg.findall(ns+pttag)
-		for pt in trkpts:
-			lat=float(pt.attrib['lat'])
-			lon=float(pt.attrib['lon'])
-			time=pt.findtext(ns+'time')
-			def prettify_time(time):
-				time=sub(r'\.\d+Z$','Z',time)
-				time=strptime(time,dateformat)
-				if tzname:
-					time=time.replace(tzinfo=pytz.utc)
-					time=time.astimezone(pytz.timezone(tzname))
-				return time
-			if time:
-				prev_time=time
-				time=prettify_time(time)
-			elif prev_time: # timestamp is missing, use the prev point
-				time=prev_time
-				time=prettify_time(time)
-			ele=pt.findtext(ns+'ele')
-			if ele:
-				ele=float(ele)
-				prev_ele=ele
-			else:
-				ele=prev_ele # elevation data is missing, use the prev point
-			s.append([lat, lon, time, ele])
-		trk.append(s)
-	return trk
+def haversine_steps(lats,lons):
+	"""Distances (km) between consecutive points on a sphere of radius R.
+	Same as distance(), but cosines of latitudes are evaluated once.
+	Error due to Earth's flattening is up to 0.5%."""
+	phi=[a*pi/180.0 for a in lats]
+	lam=[a*pi/180.0 for a in lons]
+	cosphi=[cos(a) for a in phi]
+	steps=[]
+	for i in xrange(1,len(phi)):
+		h=haversin(phi[i-1]-phi[i])+cosphi[i]*cosphi[i-1]*haversin(lam[i-1]-lam[i])
+		steps.append(2*R*asin(sqrt(h)))
+	return steps
+
+def equirect_steps(lats,lons):
+	"""Distances (km) between consecutive points, equirectangular approximation.
+	It is about twice as fast as haversine_steps(). Below 80 degrees
+	of latitude it differs from the haversine distance by less than 1e-5
+	(relative) for steps shorter than 10 km, and by less than 1e-9 for
+	steps shorter than 100 m (1 Hz tracks)."""
+	k=pi/180.0
+	steps=[]
+	for i in xrange(1,len(lats)):
+		dlon=lons[i-1]-lons[i]
+		if dlon > 180.0:
+			dlon-=360.0
+		elif dlon < -180.0:
+			dlon+=360.0
+		x=dlon*cos(0.5*k*(lats[i]+lats[i-1]))
+		y=lats[i-1]-lats[i]
+		steps.append(R*k*sqrt(x*x+y*y))
+	return steps
+
+def vincenty_steps(lats,lons):
+	"""Distances (km) between consecutive points on the WGS-84 ellipsoid,
+	Vincenty's inverse formula. Error is below 1 mm. For nearly antipodal
+	points, where the iteration does not converge, haversine is used."""
+	k=pi/180.0
+	a,f=wgs84_a,wgs84_f
+	b=a*(1-f)
+	U=[atan((1-f)*tan(lat*k)) for lat in lats]
+	sinU=[sin(u) for u in U]
+	cosU=[cos(u) for u in U]
+	steps=[]
+	for i in xrange(1,len(lats)):
+		sinU1,cosU1,sinU2,cosU2=sinU[i-1],cosU[i-1],sinU[i],cosU[i]
+		L=(lons[i]-lons[i-1])*k
+		lam=L
+		for iteration in xrange(200):
+			sinlam,coslam=sin(lam),cos(lam)
+			sinsigma=sqrt((cosU2*sinlam)**2+(cosU1*sinU2-sinU1*cosU2*coslam)**2)
+			if sinsigma == 0.0: # coincident points
+				break
+			cossigma=sinU1*sinU2+cosU1*cosU2*coslam
+			sigma=atan2(sinsigma,cossigma)
+			sinalpha=cosU1*cosU2*sinlam/sinsigma
+			cos2alpha=1-sinalpha**2
+			if cos2alpha != 0.0:
+				cos2sigmam=cossigma-2*sinU1*sinU2/cos2alpha
+			else: # equatorial line
+				cos2sigmam=0.0
+			C=f/16*cos2alpha*(4+f*(4-3*cos2alpha))
+			prev_lam=lam
+			lam=L+(1-C)*f*sinalpha*(sigma+C*sinsigma*
+					(cos2sigmam+C*cossigma*(-1+2*cos2sigmam**2)))
+			if abs(lam-prev_lam) < 1e-12:
+				break
+		else: # failed to converge
+			steps.extend(haversine_steps(lats[i-1:i+1],lons[i-1:i+1]))
+			continue
+		if sinsigma == 0.0:
+			steps.append(0.0)
+			continue
+		u2=cos2alpha*(a*a-b*b)/(b*b)
+		A=1+u2/16384*(4096+u2*(-768+u2*(320-175*u2)))
+		B=u2/1024*(256+u2*(-128+u2*(74-47*u2)))
+		deltasigma=B*sinsigma*(cos2sigmam+B/4*(cossigma*(-1+2*cos2sigmam**2)-
+				B/6*cos2sigmam*(-3+4*sinsigma**2)*(-3+4*cos2sigmam**2)))
+		steps.append(b*A*(sigma-deltasigma))
+	return steps
+
+distance_models={ 'fast': equirect_steps,
+			'equirectangular': equirect_steps,
+			'haversine': haversine_steps,
+			'ellipsoid': vincenty_steps,
+			'vincenty': vincenty_steps,
+			}
+
+def read_point(pt,tzname=None,ns=GPX10,fill_ele=True,prev=None):
+	"""Read [lat,lon,time,ele] of the point element pt. prev is the
+	[ele,time] state of the segment, which replaces missing data;
+	it is updated in place."""
+	if prev is None:
+		prev=[0.0,None]
+	lat=float(pt.attrib['lat'])
+	lon=float(pt.attrib['lon'])
+	time=pt.findtext(ns+'time')
+	def prettify_time(time):
+		time=sub(r'\.\d+Z$','Z',time)
+		time=strptime(time,dateformat)
+		if tzname:
+			time=time.replace(tzinfo=pytz.utc)
+			time=time.astimezone(pytz.timezone(tzname))
+		return time
+	if time:
+		prev[1]=time
+		time=prettify_time(time)
+	elif prev[1]: # timestamp is missing, use the prev point
+		time=prev[1]
+		time=prettify_time(time)
+	ele=pt.findtext(ns+'ele')
+	if ele:
+		ele=float(ele)
+		prev[0]=ele
+	elif fill_ele:
+		ele=prev[0] # elevation data is missing, use the prev point
+	else:
+		ele=None
+	return [lat, lon, time, ele]
+
+class HeightTiles(object):
+	"""Digital elevation model from SRTM .hgt tiles in a local directory.
+	Tiles are memory-mapped when first used, and at most maxtiles
+	of them are kept open (least recently used tiles are dropped and
+	closed when no thread reads them any more)."""
+	def __init__(self,path,maxtiles=16):
+		self.path=path
+		self.maxtiles=maxtiles
+		self.tiles=OrderedDict()
+		self.lock=threading.Lock()
+
+	def __getstate__(self): # open tiles are not passed to other processes
+		return self.path,self.maxtiles
+
+	def __setstate__(self,state):
+		self.__init__(*state)
+
+	def tile(self,key):
+		"Return (heights,side) of the tile (lat,lon) or None if it is missing."
+		if key in self.tiles:
+			t=self.tiles.pop(key)
+			self.tiles[key]=t
+			return t
+		lat,lon=key
+		name='%s%02d%s%03d.hgt'%('NS'[lat<0],abs(lat),'EW'[lon<0],abs(lon))
+		t=None
+		for fname in [name,name.lower()]:
+			fname=joinpath(self.path,fname)
+			if exists(fname):
+				f=open(fname,'rb')
+				if globals().has_key('mmap'):
+					heights=mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+				else:
+					heights=f.read()
+				f.close()
+				t=(heights,int(round(sqrt(len(heights)/2))))
+				debug('DEM tile %s, %dx%d'%(fname,t[1],t[1]))
+				break
+		self.tiles[key]=t
+		if len(self.tiles) > self.maxtiles:
+			# not closed explicitly: other threads may still be reading it,
+			# the mapping is released when the last reference is dropped
+			self.tiles.popitem(last=False)
+		return t
+
+	def heights(self,points):
+		"""Interpolate heights at (lat,lon) points bilinearly.
+		Return a list of heights, None where there are no data."""
+		result=[None]*len(points)
+		# group points by tile, so that every tile is looked up only once
+		bytile={}
+		for i,(lat,lon) in enumerate(points):
+			bytile.setdefault((int(floor(lat)),int(floor(lon))),[]).append(i)
+		unpack=hgt_pair.unpack_from
+		for key,idx in bytile.iteritems():
+			with self.lock:
+				t=self.tile(key)
+			if not t:
+				continue
+			# heights stays valid while it is referenced here, even if
+			# another thread evicts the tile meanwhile
+			heights,side=t
+			north,west=key[0]+1,key[1]
+			last=side-1
+			for i in idx:
+				lat,lon=points[i]
+				row=(north-lat)*last # rows go from north to south
+				col=(lon-west)*last
+				r,c=int(row),int(col)
+				if r >= last: r=last-1
+				if c >= last: c=last-1
+				dr,dc=row-r,col-c
+				offset=2*(r*side+c)
+				h00,h01=unpack(heights,offset)
+				h10,h11=unpack(heights,offset+2*side)
+				if h00 == hgt_void or h01 == hgt_void or \
+						h10 == hgt_void or h11 == hgt_void:
+					continue
+				result[i]=(h00*(1-dc)+h01*dc)*(1-dr)+(h10*(1-dc)+h11*dc)*dr
+		return result
+
+def correct_elevation(trk,dem,fill_only=False,budget=None):
+	"""Take elevations from dem (HeightTiles). If fill_only, replace only
+	missing elevations. Elevations still missing are copied from the
+	previous point. Points are looked up in batches of pointchunk."""
+	newtrk=[]
+	for seg in trk:
+		newseg=[]
+		prev_ele=0.0
+		points=iter(seg)
+		while True:
+			chunk=[list(p) for p in islice(points,pointchunk)]
+			if not chunk:
+				break
+			pts=[p for p in chunk if not fill_only or p[var_ele] is None]
+			for p,h in zip(pts,dem.heights([(p[0],p[1]) for p in pts])):
+				if h is not None:
+					p[var_ele]=h
+			for p in chunk:
+				if p[var_ele] is None:
+					p[var_ele]=prev_ele
+				else:
+					prev_ele=p[var_ele]
+			newseg.extend(chunk)
+			if budget:
+				newseg=budget.check(newseg)
+		if budget:
+			budget.keep(newseg)
+		newtrk.append(newseg)
+	return newtrk
+
+def parse_time(text,tzname=None):
+	"""Parse time given by user. Time is local to tzname if it is given,
+	and UTC otherwise, like the times of the parsed track. Time with
+	the Z suffix is always UTC."""
+	text=text.strip()
+	utc=text.endswith('Z')
+	if utc:
+		text=text[:-1]
+	for fmt in timeformats:
+		try:
+			time=strptime(text,fmt)
+			break
+		except ValueError:
+			pass
+	else:
+		raise ValueError("time data '%s' is not in ISO format"%text)
+	if tzname and utc:
+		time=pytz.utc.localize(time).astimezone(pytz.timezone(tzname))
+	elif tzname:
+		time=pytz.timezone(tzname).localize(time)
+	return time
+
+def time_index(trk):
+	"""Build a sorted index of track points by time.
+	Return (times,locations), where locations[i] is a (segment,point) pair
+	of the point recorded at times[i]. Points without time are not indexed."""
+	keys=[(p[var_time],i,j) for i,seg in enumerate(trk)
+			for j,p in enumerate(seg) if p[var_time]]
+	keys.sort()
+	times=[k[0] for k in keys]
+	locations=[(i,j) for t,i,j in keys]
+	return times,locations
+
+def slice_track(trk,start=None,end=None,index=None,budget=None):
+	"""Return only the points recorded between start and end (inclusive).
+	Segment boundaries and the order of points are preserved.
+	Pass index=time_index(trk) to slice the same track repeatedly.
+	With a budget, points are selected in one pass without an index."""
+	if start is None and end is None:
+		return trk
+	if budget:
+		return scan_track(trk,start,end,budget)
+	if index is None:
+		index=time_index(trk)
+	times,locations=index
+	lo,hi=0,len(times)
+	if start is not None:
+		lo=bisect_left(times,start)
+	if end is not None:
+		hi=bisect_right(times,end)
+	selected=sorted(locations[lo:hi])
+	newtrk=[]
+	prev_i=None
+	for i,j in selected:
+		if i != prev_i:
+			newseg=[]
+			newtrk.append(newseg)
+			prev_i=i
+		newseg.append(trk[i][j])
+	debug('time slice: %d pts selected'%len(selected))
+	return newtrk
+
+def scan_track(trk,start,end,budget):
+	"Select points between start and end like slice_track, point by point."
+	newtrk=[]
+	for seg in trk:
+		newseg=None
+		for p in seg:
+			time=p[var_time]
+			if not time or (start is not None and time < start) \
+					or (end is not None and time > end):
+				continue
+			if newseg is None:
+				newseg=[]
+			newseg.append(p)
+			newseg=budget.check(newseg)
+		if newseg is not None:
+			newtrk.append(budget.keep(newseg))
+	debug('time slice: %d pts selected'%sum([len(s) for s in newtrk]))
+	return newtrk
+
+def parse_size(text):
+	"Parse size in bytes, like '500000', '800k', '512M' or '2G'."
+	m=re.match(r'^\s*(\d+(\.\d*)?)\s*([kKmMgG]?)[bB]?\s*$',text)
+	if not m:
+		raise ValueError("size '%s' is not a number of bytes"%text)
+	return int(float(m.group(1))*1024**' KMG'.index(m.group(3).upper() or ' '))
+
+class SpillFile(object):
+	"""Temporary file shared by the spilled segments of a track. Blocks of
+	rows are appended at the end and read back by offset. Access is
+	serialized, so segments of one track can be used from several threads."""
+	def __init__(self):
+		self.file=None
+		self.size=0
+		self.lock=threading.Lock()
+
+	def write(self,data):
+		"Append data, return its offset."
+		with self.lock:
+			if self.file is None:
+				self.file=tempfile.TemporaryFile()
+			self.file.seek(self.size)
+			self.file.write(data)
+			offset=self.size
+			self.size+=len(data)
+			return offset
+
+	def read(self,offset,size):
+		with self.lock:
+			self.file.seek(offset)
+			return self.file.read(size)
+
+class SpilledSegment(object):
+	"""Track segment stored in a spill file rather than in memory.
+	Points are packed as rows of doubles (missing values are NaN, times
+	are seconds since the epoch) and written in blocks of at most
+	pointchunk rows, which are read back one block at a time.
+	It can be used instead of a list of points: it supports append(),
+	extend(), len(), iteration and indexing."""
+	def __init__(self,spill=None):
+		self.spill=spill or SpillFile()
+		self.width=None
+		self.zone=None
+		self.count=0
+		self.pending=[]
+		self.blocks=[] # (offset,first row,number of rows)
+
+	def encode(self,p):
+		if self.width is None:
+			self.width=len(p)
+			self.row=Struct('<%dd'%self.width)
+		row=list(p)
+		time=p[var_time]
+		if time is None:
+			row[var_time]=nan
+		else:
+			if time.tzinfo:
+				self.zone=time.tzinfo.zone
+				time=time.astimezone(pytz.utc).replace(tzinfo=None)
+			row[var_time]=(time-epoch).total_seconds()
+		if row[var_ele] is None:
+			row[var_ele]=nan
+		return self.row.pack(*row)
+
+	def decode(self,data,offset):
+		p=list(self.row.unpack_from(data,offset))
+		time=p[var_time]
+		if isnan(time):
+			p[var_time]=None
+		else:
+			time=epoch+datetime.timedelta(seconds=time)
+			if self.zone:
+				time=time.replace(tzinfo=pytz.utc)
+				time=time.astimezone(pytz.timezone(self.zone))
+			p[var_time]=time
+		if isnan(p[var_ele]):
+			p[var_ele]=None
+		return p
+
+	def append(self,p):
+		self.pending.append(self.encode(p))
+		self.count+=1
+		if len(self.pending) >= pointchunk:
+			self.flush()
+
+	def extend(self,points):
+		for p in points:
+			self.append(p)
+
+	def flush(self):
+		if self.pending:
+			offset=self.spill.write(join(self.pending,''))
+			self.blocks.append((offset,self.count-len(self.pending),
+				len(self.pending)))
+			self.pending=[]
+
+	def __len__(self):
+		return self.count
+
+	def __iter__(self):
+		self.flush()
+		for offset,first,rows in self.blocks:
+			data=self.spill.read(offset,rows*self.row.size)
+			for i in xrange(rows):
+				yield self.decode(data,i*self.row.size)
+
+	def __getitem__(self,i):
+		if i < 0:
+			i+=self.count
+		if not 0 <= i < self.count:
+			raise IndexError('segment index out of range')
+		self.flush()
+		k=bisect_right([first for offset,first,rows in self.blocks],i)-1
+		offset,first,rows=self.blocks[k]
+		size=self.row.size
+		return self.decode(self.spill.read(offset+(i-first)*size,size),0)
+
+class MemoryBudget(object):
+	"""Limit memory used by the points of the track. When the points kept
+	in lists would take more than max_memory bytes, new segments are
+	spilled to a temporary file. Stages of processing call check() while
+	they append points to a segment, and keep() when it is complete.
+	Points kept by all stages are counted, because a Track keeps the
+	tracks it was derived from."""
+	def __init__(self,max_memory):
+		self.max_memory=max_memory
+		self.used=0 # number of points in memory
+		self.spill=SpillFile()
+
+	def check(self,seg):
+		if type(seg) is list and \
+				(self.used+len(seg))*point_size > self.max_memory:
+			debug('spilling segment of %d pts'%len(seg))
+			spilled=SpilledSegment(self.spill)
+			spilled.extend(seg)
+			return spilled
+		return seg
 
-def reduce_points(trk,npoints=None):
+	def keep(self,seg):
+		if type(seg) is list:
+			self.used+=len(seg)
+		return seg
+
+def reduce_points(trk,npoints=None,budget=None):
 	count=sum([len(s) for s in trk])
 	if npoints:
 		ptperpt=1.0*count/npoints
@@ -155,87 +713,575 @@ def reduce_points(trk,npoints=None):
 	debug('ptperpt=%f skip=%d'%(ptperpt,skip))
 	newtrk=[]
 	for seg in trk:
-		if len(seg) > 0:
+		if len(seg) > 0 and type(seg) is list and not budget:
 			newseg=seg[:-1:skip]+[seg[-1]]
 			newtrk.append(newseg)
+		elif len(seg) > 0:
+			last=len(seg)-1
+			newseg=[]
+			for i,p in enumerate(seg):
+				if (i%skip == 0 and i < last) or i == last:
+					newseg.append(p)
+					if budget:
+						newseg=budget.check(newseg)
+			if budget:
+				budget.keep(newseg)
+			newtrk.append(newseg)
 	debug('original: %d pts, filtered: %d pts'%\
 			(count,sum([len(s) for s in newtrk])))
 	return newtrk
 
-def eval_dist_velocity(trk):
+def eval_dist_velocity(trk,model=None,budget=None,tzname=None):
+	"""Evaluate cumulative distance and velocity. model is a function
+	from distance_models, haversine_steps by default. Segments are
+	evaluated in chunks of pointchunk points. If tzname is given,
+	UTC times of the points are converted to this timezone."""
+	if not model:
+		model=haversine_steps
 	dist=0.0
 	newtrk=[]
 	for seg in trk:
 		if len(seg)>0:
 			newseg=[]
 			prev_lat,prev_lon,prev_time,prev_ele=None,None,None,None
-			for pt in seg:
-				lat,lon,time,ele=pt
-				if prev_lat and prev_lon:
-					delta=distance([lat,lon],[prev_lat,prev_lon])
-					if time and prev_time:
-						try:
-							vel=3600*delta/((time-prev_time).seconds)
-						except ZeroDivisionError:
-							vel=0.0 # probably the point lacked the timestamp
-					else: 
+			points=iter(seg)
+			prev_pt=None
+			while True:
+				chunk=list(islice(points,pointchunk))
+				if not chunk:
+					break
+				if prev_pt:
+					steps=model([p[0] for p in [prev_pt]+chunk],
+							[p[1] for p in [prev_pt]+chunk])
+				else:
+					steps=[0.0]+model([p[0] for p in chunk],[p[1] for p in chunk])
+				prev_pt=chunk[-1]
+				for pt,step in zip(chunk,steps):
+					lat,lon,time,ele=pt
+					if prev_lat and prev_lon:
+						delta=step
+						if time and prev_time:
+							try:
+								vel=3600*delta/((time-prev_time).seconds)
+							except ZeroDivisionError:
+								vel=0.0 # probably the point lacked the timestamp
+						else: 
+							vel=0.0
+					else: # new segment
+						delta=0.0
 						vel=0.0
-				else: # new segment
-					delta=0.0
-					vel=0.0
-				dist=dist+delta
-				newseg.append([lat,lon,time,ele,dist,vel])
-				prev_lat,prev_lon,prev_time=lat,lon,time
+					dist=dist+delta
+					newseg.append([lat,lon,local_time(time,tzname),ele,dist,vel])
+					prev_lat,prev_lon,prev_time=lat,lon,time
+				if budget:
+					newseg=budget.check(newseg)
+			if budget:
+				budget.keep(newseg)
 			newtrk.append(newseg)
 	return newtrk
 
-def parse_gpx_data(gpxdata,tzname=None,npoints=None):
+def import_etree():
 	try:
-		import xml.etree.ElementTree as ET
+		import xml.etree.cElementTree as ET
 	except:
 		try:
-			import elementtree.ElementTree as ET
+			import xml.etree.ElementTree as ET
 		except:
 			try:
-				import cElementTree as ET
+				import elementtree.ElementTree as ET
 			except:
 				try:
-					import lxml.etree as ET
+					import cElementTree as ET
 				except:
-					print 'this script needs ElementTree (Python>=2.5)'
-					sys.exit(EXIT_EDEPENDENCY)
-
-	def find_trksegs_or_route(etree, ns):
-		trksegs=etree.findall('.//'+ns+'trkseg')
-		if trksegs:
-			return trksegs, "trkpt"
-		else: # try to display route if track is missing
-			rte=etree.findall('.//'+ns+'rte')
-			return rte, "rtept"
-
-	# try GPX10 namespace first
-	etree=ET.XML(gpxdata)
-	trksegs,pttag=find_trksegs_or_route(etree, GPX10)
-	NS=GPX10
-	if not trksegs: # try GPX11 namespace otherwise
-		trksegs,pttag=find_trksegs_or_route(etree, GPX11)
-		NS=GPX11
-	if not trksegs: # try without any namespace
-		trksegs,pttag=find_trksegs_or_route(etree, "")
-		NS=""
-	trk=read_all_segments(trksegs,tzname=tzname,ns=NS,pttag=pttag)
-	trk=reduce_points(trk,npoints=npoints)
-	trk=eval_dist_velocity(trk)
-	return trk
-
-def read_gpx_trk(filename,tzname,npoints):
+					try:
+						import lxml.etree as ET
+					except:
+						raise ImportError('this script needs ElementTree (Python>=2.5)')
+	return ET
+
+class InputStream(object):
+	"""File-like wrapper which decompresses the underlying file while it is
+	read. Compression method is detected by magic bytes, so the file
+	does not need to be seekable (e.g. stdin)."""
+	def __init__(self,fileobj):
+		self.fileobj=fileobj
+		self.pending=fileobj.read(chunksize) # data read ahead from fileobj
+		self.method=None
+		for magic,method in magic_numbers:
+			if self.pending.startswith(magic):
+				self.method=method
+		debug('compression: %s'%self.method)
+		self.decompressor=self.new_decompressor()
+		self.buf=''
+		self.eof=False
+
+	def new_decompressor(self):
+		if self.method == 'gzip':
+			return zlib.decompressobj(16+zlib.MAX_WBITS)
+		elif self.method == 'bzip2':
+			return bz2.BZ2Decompressor()
+		elif self.method == 'xz':
+			if not globals().has_key('lzma'):
+				raise ImportError('lzma module is required to read xz files')
+			return lzma.LZMADecompressor()
+		else:
+			return None
+
+	def fill(self,size):
+		"Decompress data until there are at least size bytes in the buffer."
+		chunks=[self.buf]
+		buflen=len(self.buf)
+		while not self.eof and (size < 0 or buflen < size):
+			data=self.pending or self.fileobj.read(chunksize)
+			self.pending=''
+			if not data:
+				self.eof=True
+				if self.decompressor and not self.finished():
+					raise IOError('%s data are truncated'%self.method)
+				break
+			if self.decompressor:
+				try:
+					out=self.decompressor.decompress(data)
+				except EOFError: # the previous stream ended with the chunk
+					self.decompressor=self.new_decompressor()
+					out=self.decompressor.decompress(data)
+				unused=self.decompressor.unused_data
+				if unused.strip('\0'): # concatenated compressed streams
+					self.decompressor=self.new_decompressor()
+					self.pending=unused
+				data=out
+			chunks.append(data)
+			buflen+=len(data)
+		self.buf=join(chunks,'')
+
+	def finished(self):
+		"""Return True if the compressed stream has ended. A byte past
+		the end is left unused (EOFError for bz2 and xz), while a truncated
+		stream takes it as data."""
+		try:
+			self.decompressor.decompress('\0')
+		except EOFError:
+			return True
+		except Exception: # invalid continuation of a truncated stream
+			return False
+		return bool(self.decompressor.unused_data)
+
+	def peek(self,size):
+		self.fill(size)
+		return self.buf[:size]
+
+	def read(self,size=-1):
+		if not self.method and not self.buf and not self.pending:
+			return self.fileobj.read(size) # nothing to decompress
+		self.fill(size)
+		if size < 0:
+			data,self.buf=self.buf,''
+		else:
+			data,self.buf=self.buf[:size],self.buf[size:]
+		return data
+
+	def close(self):
+		self.fileobj.close()
+
+def open_gpx(filename):
+	"Open GPX file (possibly compressed) for reading, '-' means stdin."
 	if filename == "-":
-		gpx=sys.stdin.read()
-		debug("length(gpx) from stdin = %d" % len(gpx))
+		return InputStream(sys.stdin)
+	return InputStream(open(filename,'rb'))
+
+def is_gpx_name(name):
+	return re.search(r'\.gpx(\.(gz|bz2|xz))?$',name.lower()) is not None
+
+def iter_gpx_members(filename):
+	"""Iterate over GPX files in a zip or tar archive without extracting it,
+	yield (name,stream) pairs. A plain GPX file is the only member of itself.
+	Each stream should be consumed before the next one is requested."""
+	if filename != "-" and zipfile.is_zipfile(filename):
+		archive=zipfile.ZipFile(filename)
+		for info in archive.infolist():
+			if is_gpx_name(info.filename):
+				debug('zip member: %s'%info.filename)
+				yield info.filename,InputStream(archive.open(info))
+		archive.close()
+		return
+	stream=open_gpx(filename)
+	head=stream.peek(512)
+	if head[257:262] == 'ustar': # tar archive, possibly compressed
+		archive=tarfile.open(fileobj=stream,mode='r|')
+		for info in archive:
+			if info.isfile() and is_gpx_name(info.name):
+				debug('tar member: %s'%info.name)
+				yield info.name,InputStream(archive.extractfile(info))
+		archive.close()
+	elif head.startswith('PK\x03\x04'):
+		raise ValueError('zip archives cannot be read from stdin')
 	else:
-		gpx=open(filename).read()
-		debug("length(gpx) from file = %d" % len(gpx))
-	return parse_gpx_data(gpx,tzname,npoints)
+		yield filename,stream
+	stream.close()
+
+def iter_gpx_segments(stream,tzname=None,fill_ele=True,budget=None):
+	"""Parse GPX data incrementally and yield track segments one by one.
+	Point elements are discarded as soon as they are read.
+	If there are no track segments, yield routes instead.
+	Missing elevations are None if not fill_ele."""
+	ET=import_etree()
+	routes,found_trk=[],False
+	seg,container=None,None
+	for event,elem in ET.iterparse(stream,events=('start','end')):
+		ns,tag=re.match(r'(\{.*\})?(.*)',elem.tag).groups()
+		ns=ns or ""
+		if ns not in [GPX10,GPX11,""]:
+			continue
+		if event == 'start':
+			if pttags.has_key(tag):
+				seg,container,prev=[],elem,[0.0,None]
+				pttag=ns+pttags[tag]
+		elif container is None:
+			continue
+		elif elem.tag == pttag:
+			seg.append(read_point(elem,tzname,ns,fill_ele,prev))
+			container.clear() # drop points which are already read
+			if budget:
+				seg=budget.check(seg)
+		elif elem is container:
+			if budget:
+				budget.keep(seg)
+			if tag == 'trkseg':
+				found_trk,routes=True,[]
+				yield seg
+			elif not found_trk: # try to display route if track is missing
+				routes.append(seg)
+			seg,container=None,None
+	for seg in routes:
+		yield seg
+
+def iter_gpx_points(filename,fill_ele=True):
+	"""Parse track points of a GPX file, or of all GPX files in an archive,
+	and yield them one by one as [lat,lon,time,ele]. Points without
+	time are skipped."""
+	ET=import_etree()
+	for name,stream in iter_gpx_members(filename):
+		container=None
+		for event,elem in ET.iterparse(stream,events=('start','end')):
+			ns,tag=re.match(r'(\{.*\})?(.*)',elem.tag).groups()
+			ns=ns or ""
+			if ns not in [GPX10,GPX11,""]:
+				continue
+			if event == 'start':
+				if tag == 'trkseg':
+					container,prev=elem,[0.0,None]
+					pttag=ns+pttags[tag]
+			elif container is None:
+				continue
+			elif elem.tag == pttag:
+				p=read_point(elem,None,ns,fill_ele,prev)
+				container.clear()
+				if p[var_time] is not None:
+					yield p
+			elif elem is container:
+				container=None
+
+def merge_points(sources):
+	"""k-way merge of time-ordered point iterators into one time-ordered
+	iterator. Only the next point of every source is kept in the heap.
+	Points recorded at the same time keep the order of the sources."""
+	heap=[]
+	for i,source in enumerate(sources):
+		source=iter(source)
+		for p in source:
+			heap.append((p[var_time],i,p,source))
+			break
+	heapq.heapify(heap)
+	while heap:
+		time,i,p,source=heap[0]
+		yield p
+		for p in source:
+			heapq.heapreplace(heap,(p[var_time],i,p,source))
+			break
+		else:
+			heapq.heappop(heap)
+
+def iter_merged_segments(filenames,gap=merge_gap,fill_ele=True,budget=None):
+	"""Merge track points of several files in time order, yield segments
+	of the merged track. Exact duplicates of a point are dropped, a new
+	segment is started where no points were recorded for gap seconds."""
+	seg,last,seen=[],None,set()
+	sources=[iter_gpx_points(f,fill_ele) for f in filenames]
+	for p in merge_points(sources):
+		time=p[var_time]
+		if time == last:
+			if tuple(p) in seen:
+				continue
+		else:
+			if last and seg and (time-last).total_seconds() > gap:
+				if budget:
+					budget.keep(seg)
+				yield seg
+				seg=[]
+			last,seen=time,set()
+		seen.add(tuple(p))
+		seg.append(p)
+		if budget:
+			seg=budget.check(seg)
+	if seg:
+		if budget:
+			budget.keep(seg)
+		yield seg
+
+def parse_step(text):
+	"""Parse resampling step, like '30s', '2min', '100m', '0.5km' or '1mi'.
+	Return (var_time,seconds) or (var_dist,kilometers)."""
+	m=re.match(r'^\s*(\d+(\.\d*)?|\.\d+)\s*([a-z]+)\s*$',text.lower())
+	if not m or not step_units.has_key(m.group(3)):
+		raise ValueError("step '%s' should be a number with units %s"%\
+				(text,join(sorted(step_units.keys()),', ')))
+	var,factor=step_units[m.group(3)]
+	step=float(m.group(1))*factor
+	if step <= 0:
+		raise ValueError("step '%s' should be positive"%text)
+	return var,step
+
+def resample_track(trk,step,var=var_time,budget=None):
+	"""Interpolate evaluated track on a uniform grid of time (step in
+	seconds) or distance (step in km). Grid starts at the beginning
+	of the track; segments are resampled separately, so gaps between
+	them are preserved. Velocity is the mean velocity since the previous
+	grid point. Points without time are skipped when resampling on time."""
+	t0=None
+	for seg in trk:
+		for p in seg:
+			if p[var_time]:
+				t0=p[var_time]
+				break
+		if t0:
+			break
+	if var == var_time and not t0:
+		return []
+	def key(p):
+		if var == var_time:
+			return (p[var_time]-t0).total_seconds()
+		else:
+			return p[var_dist]
+	def interpolate(a,b,frac,x):
+		lat=a[0]+frac*(b[0]-a[0])
+		lon=a[1]+frac*(b[1]-a[1])
+		ele=a[var_ele]+frac*(b[var_ele]-a[var_ele])
+		if var == var_time:
+			time=t0+datetime.timedelta(seconds=x)
+			dist=a[var_dist]+frac*(b[var_dist]-a[var_dist])
+		else:
+			time,dist=a[var_time],x
+			if a[var_time] and b[var_time]:
+				dt=(b[var_time]-a[var_time]).total_seconds()
+				time=time+datetime.timedelta(seconds=frac*dt)
+		if time and time.tzinfo and hasattr(time.tzinfo,'normalize'):
+			time=time.tzinfo.normalize(time) # fix DST offset
+		return [lat,lon,time,ele,dist,0.0]
+	newtrk=[]
+	for seg in trk:
+		# the grid only moves forward: walk the segment keeping the
+		# previous point a and the next point b around the grid point x
+		newseg,q=[],None
+		a,ka,k=None,None,None
+		for b in seg:
+			if var == var_time and not b[var_time]:
+				continue
+			kb=key(b)
+			if k is None:
+				k=int(ceil(kb/step))
+			while k*step <= kb:
+				x=k*step
+				if a is None or kb == x:
+					p=interpolate(b,b,0.0,x)
+				else:
+					p=interpolate(a,b,(x-ka)/(kb-ka),x)
+				if q and p[var_time] and q[var_time] and p[var_time] > q[var_time]:
+					p[var_vel]=3600*(p[var_dist]-q[var_dist])/\
+							(p[var_time]-q[var_time]).total_seconds()
+				newseg.append(p)
+				if budget:
+					newseg=budget.check(newseg)
+				q=p
+				k+=1
+			a,ka=b,kb
+		if newseg:
+			if budget:
+				budget.keep(newseg)
+			newtrk.append(newseg)
+	debug('resampled: %d pts'%sum([len(s) for s in newtrk]))
+	return newtrk
+
+def local_time(time,tzname=None):
+	"Convert UTC time of the track to the timezone tzname."
+	if time is None or not tzname:
+		return time
+	time=time.replace(tzinfo=pytz.utc)
+	return time.astimezone(pytz.timezone(tzname))
+
+class Track(object):
+	"""GPS track read from GPX data.
+
+	Points are kept as they are read, [lat,lon,time,ele] in every segment,
+	with times in UTC. Derived data (distance and velocity, local times,
+	values in English units) are evaluated on first access and memoized.
+	Methods which select points return new tracks. Tracks can be shared
+	between threads."""
+	def __init__(self,segments,tzname=None,model=None,budget=None):
+		self.segments=segments
+		self.tzname=tzname
+		self.model=model
+		self.budget=budget
+		self.lock=threading.RLock()
+		self.memo={}
+
+	@classmethod
+	def from_stream(cls,stream,tzname=None,model=None,fill_ele=True,
+			max_memory=None):
+		"""Parse GPX data from a file-like object. Missing elevations are
+		None if not fill_ele. Points which do not fit into max_memory
+		bytes are spilled to a temporary file."""
+		budget=max_memory and MemoryBudget(max_memory)
+		segments=list(iter_gpx_segments(stream,fill_ele=fill_ele,budget=budget))
+		return cls(segments,tzname,model,budget)
+
+	@classmethod
+	def from_string(cls,gpxdata,**kwargs):
+		return cls.from_stream(StringIO.StringIO(gpxdata),**kwargs)
+
+	@classmethod
+	def from_file(cls,filename,tzname=None,model=None,fill_ele=True,
+			max_memory=None):
+		"Read GPX file or all GPX files of an archive as one track."
+		budget=max_memory and MemoryBudget(max_memory)
+		segments=[]
+		for name,stream in iter_gpx_members(filename):
+			segments.extend(iter_gpx_segments(stream,fill_ele=fill_ele,
+				budget=budget))
+		return cls(segments,tzname,model,budget)
+
+	@classmethod
+	def from_files(cls,filenames,gap=merge_gap,tzname=None,model=None,
+			fill_ele=True,max_memory=None):
+		"""Merge GPX files into one track in time order (see
+		iter_merged_segments). Points of every file should be recorded
+		in time order."""
+		budget=max_memory and MemoryBudget(max_memory)
+		segments=list(iter_merged_segments(filenames,gap,fill_ele,budget))
+		return cls(segments,tzname,model,budget)
+
+	def memoized(self,key,compute):
+		with self.lock:
+			if not self.memo.has_key(key):
+				self.memo[key]=compute()
+			return self.memo[key]
+
+	def derive(self,segments):
+		return Track(segments,self.tzname,self.model,self.budget)
+
+	def __len__(self):
+		return sum([len(seg) for seg in self.segments])
+
+	def utc(self,time):
+		"""Convert time given by user to the time of the track points (naive
+		UTC). Aware times are converted from their own timezone. Naive times
+		are local to tzname of the track if it has one, and UTC otherwise."""
+		if not time:
+			return time
+		if not time.tzinfo and self.tzname:
+			time=pytz.timezone(self.tzname).localize(time)
+		if time.tzinfo:
+			time=time.astimezone(pytz.utc).replace(tzinfo=None)
+		return time
+
+	def sliced(self,start=None,end=None):
+		"""Return points recorded between start and end (see slice_track).
+		start and end are datetimes, converted as described in utc()."""
+		if start is None and end is None:
+			return self
+		if self.budget: # an index would hold every point, scan instead
+			return self.derive(slice_track(self.segments,self.utc(start),
+				self.utc(end),budget=self.budget))
+		index=self.memoized('time_index',lambda: time_index(self.segments))
+		return self.derive(slice_track(self.segments,self.utc(start),
+			self.utc(end),index=index))
+
+	def reduced(self,npoints=None):
+		"Return approximately npoints points of the track."
+		if not npoints:
+			return self
+		return self.derive(reduce_points(self.segments,npoints,self.budget))
+
+	def corrected(self,dem,fill_only=False):
+		"Return the track with elevations from dem (see correct_elevation)."
+		return self.derive(correct_elevation(self.segments,dem,fill_only,
+			self.budget))
+
+	def evaluated(self):
+		"""Return segments of [lat,lon,time,ele,dist,vel] points, where time
+		is local, dist is cumulative distance (km) and vel is velocity (km/h)."""
+		return self.memoized('evaluated',lambda:
+			eval_dist_velocity(self.segments,model=self.model,
+				budget=self.budget,tzname=self.tzname))
+
+	def resampled(self,step,var=var_time):
+		"Return evaluated track interpolated on a uniform grid of var."
+		return self.memoized(('resampled',step,var),lambda:
+			resample_track(self.evaluated(),step,var=var,budget=self.budget))
+
+	def column(self,var,metric=True):
+		"""Return values of var (var_time, var_ele, var_dist or var_vel)
+		in every non-empty segment. Distance and velocity are evaluated
+		only if they are requested."""
+		def compute():
+			if var in [var_dist,var_vel]:
+				rows=self.evaluated()
+			else:
+				rows=[seg for seg in self.segments if len(seg) > 0]
+			if var == var_time:
+				return [[local_time(p[var_time],self.tzname) for p in seg]
+						for seg in rows]
+			if metric:
+				factor=1.0
+			elif var == var_ele:
+				factor=feetperm
+			else:
+				factor=milesperkm
+			def convert(v):
+				if v is None: # missing elevation
+					return v
+				return factor*v
+			return [[convert(p[var]) for p in seg] for seg in rows]
+		return self.memoized(('column',var,metric),compute)
+
+	times=property(lambda self: self.column(var_time))
+	elevations=property(lambda self: self.column(var_ele))
+	distances=property(lambda self: self.column(var_dist))
+	velocities=property(lambda self: self.column(var_vel))
+
+def evaluate(track,npoints=None,start=None,end=None,dem=None,dem_fill=False,
+		resample=None):
+	"""Select points of the track, correct elevations and evaluate it,
+	as requested on the command line. Return segments of points
+	[lat,lon,time,ele,dist,vel]."""
+	track=track.sliced(start,end).reduced(npoints)
+	if dem:
+		track=track.corrected(dem,fill_only=dem_fill)
+	if resample:
+		var,step=resample
+		return track.resampled(step,var)
+	return track.evaluated()
+
+def parse_gpx_data(gpxdata,tzname=None,npoints=None,start=None,end=None,
+		dem=None,dem_fill=False,model=None,max_memory=None,resample=None):
+	track=Track.from_string(gpxdata,tzname=tzname,model=model,
+			fill_ele=not dem,max_memory=max_memory)
+	return evaluate(track,npoints,start,end,dem,dem_fill,resample)
+
+def read_gpx_trk(filename,tzname,npoints,start=None,end=None,
+		dem=None,dem_fill=False,model=None,max_memory=None,resample=None):
+	track=Track.from_file(filename,tzname=tzname,model=model,
+			fill_ele=not dem,max_memory=max_memory)
+	return evaluate(track,npoints,start,end,dem,dem_fill,resample)
 
 def google_ext_encode(i):
 	"""Google Charts' extended encoding,
@@ -278,10 +1324,51 @@ def google_ext_encode_data(trk,x,y,min_x,max_x,min_y,max_y,metric=True):
 			for seg in trk if len(seg) > 0],',')
 	return data
 
+def encode_polyline(points,precision=5):
+	"""Encode a sequence of points with the encoded polyline algorithm,
+	see https://developers.google.com/maps/documentation/utilities/polylinealgorithm
+	Every coordinate is rounded to precision decimal digits (precision may
+	be a list, one value per coordinate) and delta-encoded."""
+	if not points:
+		return ''
+	if not isinstance(precision,(list,tuple)):
+		precision=[precision]*len(points[0])
+	factors=[10**d for d in precision]
+	chunks=[]
+	prev=[0]*len(factors)
+	for p in points:
+		for i,(v,f) in enumerate(zip(p,factors)):
+			v=int(round(v*f))
+			delta,prev[i]=v-prev[i],v
+			delta=~(delta<<1) if delta < 0 else delta<<1
+			while delta >= 0x20:
+				chunks.append(chr((0x20|(delta&0x1f))+63))
+				delta>>=5
+			chunks.append(chr(delta+63))
+	return join(chunks,'')
+
+def polyline_profile(trk,metric=True):
+	"""Return the track path and its distance-elevation profile as encoded
+	polylines, one per segment, in a dictionary ready for JSON."""
+	if metric:
+		ele_units,dist_units='m','km'
+		km,m=1.0,1.0
+	else:
+		ele_units,dist_units='ft','miles'
+		km,m=milesperkm,feetperm
+	segs=[seg for seg in trk if len(seg) > 0]
+	return {'units': {'distance': dist_units,'elevation': ele_units},
+			'precision': {'path': [5,5],'profile': [3,1]},
+			'npoints': sum([len(seg) for seg in segs]),
+			'path': [encode_polyline([(p[0],p[1]) for p in seg],5)
+				for seg in segs],
+			'profile': [encode_polyline([(km*p[var_dist],m*p[var_ele])
+				for p in seg],[3,1]) for seg in segs],
+			}
+
 def google_chart_url(trk,x,y,metric=True):
 	if x != var_dist or y != var_ele:
-		print 'only distance-elevation profiles are supported in --google mode'
-		return
+		raise ValueError('only distance-elevation profiles are supported in --google mode')
 	if not trk:
 		raise ValueError("Parsed track is empty")
 	if metric:
@@ -304,26 +1391,35 @@ def google_chart_url(trk,x,y,metric=True):
 		raise OverflowError("URL too long, reduce number of points: "+(url))
 	return url
 
-def print_gpx_trk(trk,file=sys.stdout,metric=True):
-	f=file
+def table_units(metric=True):
+	"Return the header and the (km,m) unit factors of the data table."
 	if metric:
-		f.write('# time(ISO) elevation(m) distance(km) velocity(km/h)\n')
-		km,m=1.0,1.0
+		return '# time(ISO) elevation(m) distance(km) velocity(km/h)\n',\
+				(1.0,1.0)
 	else:
-		f.write('# time(ISO) elevation(ft) distance(miles) velocity(miles/h)\n')
-		km,m=milesperkm,feetperm
+		return '# time(ISO) elevation(ft) distance(miles) velocity(miles/h)\n',\
+				(milesperkm,feetperm)
+
+def table_row(p,km,m):
+	return '%s %f %f %f\n'%\
+		((p[var_time].isoformat(),\
+		m*p[var_ele],km*p[var_dist],km*p[var_vel]))
+
+def print_gpx_trk(trk,file=sys.stdout,metric=True):
+	f=file
+	header,(km,m)=table_units(metric)
+	f.write(header)
 	if not trk:
 		return
 	for seg in trk:
 		if len(seg) == 0:
 			continue
 		for p in seg:
-			f.write('%s %f %f %f\n'%\
-				((p[var_time].isoformat(),\
-				m*p[var_ele],km*p[var_dist],km*p[var_vel])))
+			f.write(table_row(p,km,m))
 		f.write('\n')
 
-def gen_gnuplot_script(trk,x,y,file=sys.stdout,metric=True,savefig=None):
+def gen_gnuplot_header(x,y,file=sys.stdout,metric=True,savefig=None):
+	"Write gnuplot commands which precede the inline data."
 	if metric:
 		ele_units,dist_units='m','km'
 	else:
@@ -340,7 +1436,6 @@ def gen_gnuplot_script(trk,x,y,file=sys.stdout,metric=True,savefig=None):
 	else:
 		file.write("set ylabel 'velocity, %s/h\n"%dist_units)
 	if savefig:
-		import re
 		ext=re.sub(r'.*\.','',savefig.lower())
 		if ext == 'png':
 			file.write("set terminal png; set output '%s';\n"%(savefig))
@@ -351,14 +1446,15 @@ def gen_gnuplot_script(trk,x,y,file=sys.stdout,metric=True,savefig=None):
 		elif ext == 'svg':
 			file.write("set terminal svg; set output '%s';\n"%(savefig))
 		else:
-			print 'unsupported file type: %s'%ext
-			sys.exit(EXIT_EFORMAT)
+			raise ValueError('unsupported file type: %s'%ext)
 	file.write("plot '-' u %d:%d w l\n"%(x-1,y-1,))
+
+def gen_gnuplot_script(trk,x,y,file=sys.stdout,metric=True,savefig=None):
+	gen_gnuplot_header(x,y,file=file,metric=metric,savefig=savefig)
 	print_gpx_trk(trk,file=file,metric=metric)
 	file.write('e')
 
 def get_gnuplot_script(trk,x,y,metric,savefig):
-	import StringIO
 	script=StringIO.StringIO()
 	gen_gnuplot_script(trk,x,y,file=script,metric=metric,savefig=savefig)
 	script=script.getvalue()
@@ -380,6 +1476,673 @@ def print_gnuplot_script(trk,x,y,metric=True,savefig=None):
 	script=get_gnuplot_script(trk,x,y,metric,savefig)
 	print script
 
+def parse_output_spec(spec):
+	"""Parse output specification 'action[:units]=filename'.
+	Return (action,metric,filename); metric is None if units are not given."""
+	if '=' not in spec:
+		raise ValueError("output '%s' is not action=filename"%spec)
+	name,filename=spec.split('=',1)
+	name,units=(name+':').split(':')[:2]
+	if not action_names.has_key(name):
+		raise ValueError("unknown output action '%s'"%name)
+	if units in ['E','english']:
+		metric=False
+	elif units in ['m','metric']:
+		metric=True
+	elif not units:
+		metric=None
+	else:
+		raise ValueError("unknown units '%s'"%units)
+	return action_names[name],metric,filename
+
+def open_output(filename):
+	"Open output file for writing, '-' means stdout."
+	if filename == '-':
+		return sys.stdout
+	return open(filename,'w')
+
+def close_output(f):
+	if f is not sys.stdout:
+		f.close()
+
+def write_outputs(trk,outputs,x=var_dist,y=var_ele,savefig=None):
+	"""Produce several outputs of the same evaluated track. outputs is
+	a list of (action,metric,filename), filename '-' means stdout.
+	Data tables and gnuplot scripts are all written in one pass over
+	the track, and every row is formatted once per unit system."""
+	tables=[]
+	for action,metric,filename in outputs:
+		if action in ['printtable','printgnuplot']:
+			f=open_output(filename)
+			if action == 'printgnuplot':
+				gen_gnuplot_header(x,y,file=f,metric=metric,savefig=savefig)
+			header,units=table_units(metric)
+			f.write(header)
+			tables.append((f,units,action))
+	if trk and tables:
+		for seg in trk:
+			if len(seg) == 0:
+				continue
+			for p in seg:
+				rows={}
+				for f,units,action in tables:
+					if not rows.has_key(units):
+						rows[units]=table_row(p,*units)
+					f.write(rows[units])
+			for f,units,action in tables:
+				f.write('\n')
+	for f,units,action in tables:
+		if action == 'printgnuplot':
+			f.write('e\n')
+		close_output(f)
+	for action,metric,filename in outputs:
+		if action == 'gnuplot':
+			if filename == '-':
+				filename=None # plot interactively
+			plot_in_gnuplot(trk,x=x,y=y,metric=metric,savefig=filename)
+		elif action == 'googlechart':
+			url=google_chart_url(trk,x=x,y=y,metric=metric)
+			if url:
+				f=open_output(filename)
+				f.write(url+'\n')
+				close_output(f)
+
+def cpu_count():
+	"Number of worker processes to use by default."
+	if not globals().has_key('multiprocessing'):
+		return 1
+	return multiprocessing.cpu_count()
+
+def parse_bbox(text):
+	"Parse bounding box 'lat1,lon1,lat2,lon2', return (south,west,north,east)."
+	try:
+		lat1,lon1,lat2,lon2=[float(a) for a in text.split(',')]
+	except ValueError:
+		raise ValueError("bounding box '%s' is not lat1,lon1,lat2,lon2"%text)
+	if lat1 == lat2 or lon1 == lon2:
+		raise ValueError("bounding box '%s' is empty"%text)
+	return min(lat1,lat2),min(lon1,lon2),max(lat1,lat2),max(lon1,lon2)
+
+def parse_seconds(text):
+	"Parse a positive number of seconds, like '30' or '0.5'."
+	try:
+		sec=float(text)
+	except ValueError:
+		sec=0
+	if not sec > 0 or isinf(sec): # also rejects nan
+		raise ValueError("'%s' is not a positive number of seconds"%text)
+	return sec
+
+def parse_grid_size(text):
+	"Parse raster size 'WIDTHxHEIGHT'."
+	m=re.match(r'^\s*(\d+)\s*[xX]\s*(\d+)\s*$',text)
+	if not m or not int(m.group(1)) or not int(m.group(2)):
+		raise ValueError("raster size '%s' is not WIDTHxHEIGHT"%text)
+	return int(m.group(1)),int(m.group(2))
+
+def bin_points(trk,bbox,width,height,grid=None):
+	"""Count track points in the cells of width x height raster over bbox
+	(south,west,north,east). Rows go from north to south.
+	Return the grid, an array of width*height counts."""
+	if grid is None:
+		grid=array('I',[0])*(width*height)
+	south,west,north,east=bbox
+	sx=width/(east-west)
+	sy=height/(north-south)
+	for seg in trk:
+		for p in seg:
+			x=(p[1]-west)*sx
+			y=(north-p[0])*sy
+			if 0 <= x < width and 0 <= y < height:
+				grid[int(y)*width+int(x)]+=1
+	return grid
+
+def heatmap_worker(job):
+	"""Bin points of several GPX files into one partial grid.
+	Return (grid,failed), failed is the number of files not processed."""
+	filenames,bbox,width,height,tzname,start,end=job
+	grid=array('I',[0])*(width*height)
+	failed=0
+	for filename in filenames:
+		try:
+			for name,stream in iter_gpx_members(filename):
+				trk=iter_gpx_segments(stream,tzname=tzname)
+				if start or end:
+					trk=slice_track(list(trk),start=start,end=end)
+				bin_points(trk,bbox,width,height,grid)
+		except Exception, e: # skip broken files, but report them
+			sys.stderr.write('%s: %s\n'%(filename,e))
+			failed+=1
+	return grid,failed
+
+def heatmap(filenames,bbox,width,height,jobs=None,
+		tzname=None,start=None,end=None):
+	"""Count points of all tracks in the cells of the raster over bbox.
+	Files are distributed between jobs worker processes (one per CPU
+	by default), and their partial grids are summed. Return (grid,failed),
+	failed is the number of files which could not be read."""
+	if jobs is None:
+		jobs=cpu_count()
+	jobs=max(1,min(jobs,len(filenames)))
+	nchunks=min(len(filenames),4*jobs) # to balance unequal files
+	chunks=[(filenames[i::nchunks],bbox,width,height,tzname,start,end)
+			for i in xrange(nchunks)]
+	if jobs > 1:
+		pool=multiprocessing.Pool(jobs)
+		partials=pool.imap_unordered(heatmap_worker,chunks)
+	else:
+		partials=itertools.imap(heatmap_worker,chunks)
+	grid=array('I',[0])*(width*height)
+	failed=0
+	for partial,nfailed in partials:
+		failed+=nfailed
+		for i,c in enumerate(partial):
+			if c:
+				grid[i]+=c
+	if jobs > 1:
+		pool.close()
+		pool.join()
+	return grid,failed
+
+def write_png(f,pixels,width,height):
+	"Write 8-bit grayscale PNG image, pixels is a string of width*height bytes."
+	def chunk(tag,data):
+		return pack('>I',len(data))+tag+data+\
+				pack('>I',zlib.crc32(tag+data)&0xffffffff)
+	rows=join(['\0'+pixels[r*width:(r+1)*width] for r in xrange(height)],'')
+	f.write('\x89PNG\r\n\x1a\n')
+	f.write(chunk('IHDR',pack('>IIBBBBB',width,height,8,0,0,0,0)))
+	f.write(chunk('IDAT',zlib.compress(rows,6)))
+	f.write(chunk('IEND',''))
+
+def write_heatmap(grid,width,height,filename):
+	"""Save heatmap to PNG (log scale, brighter is denser) or, for other
+	file types, as a raw row-major array of 32-bit counts."""
+	f=open(filename,'wb')
+	if filename.lower().endswith('.png'):
+		top=log(1+max(grid)) or 1.0
+		pixels=join([chr(int(255*log(1+c)/top)) for c in grid],'')
+		write_png(f,pixels,width,height)
+	else:
+		grid.tofile(f)
+	f.close()
+
+def file_digest(filename):
+	"Return SHA-1 hex digest of the file content."
+	h=hashlib.sha1()
+	f=open(filename,'rb')
+	while True:
+		data=f.read(chunksize)
+		if not data:
+			break
+		h.update(data)
+	f.close()
+	return h.hexdigest()
+
+def geohash(lat,lon,precision=7):
+	"Encode position as a geohash of precision characters."
+	lats,lons=[-90.0,90.0],[-180.0,180.0]
+	chars=[]
+	bit,ch,even=0,0,True
+	while len(chars) < precision:
+		if even:
+			interval,v=lons,lon
+		else:
+			interval,v=lats,lat
+		mid=0.5*(interval[0]+interval[1])
+		if v >= mid:
+			ch=ch|(16>>bit)
+			interval[0]=mid
+		else:
+			interval[1]=mid
+		even=not even
+		bit+=1
+		if bit == 5:
+			chars.append(geohash_alphabet[ch])
+			bit,ch=0,0
+	return join(chars,'')
+
+def route_fingerprint(trk,precision=7):
+	"""Return the sequence of geohash cells visited by the track, with
+	repeated consecutive cells removed. precision 7 means cells about
+	150 m wide."""
+	cells=[]
+	for seg in trk:
+		for p in seg:
+			cell=geohash(p[0],p[1],precision)
+			if not cells or cells[-1] != cell:
+				cells.append(cell)
+	return cells
+
+def route_similarity(cells1,cells2):
+	"Jaccard similarity of the sets of cells visited by two routes."
+	s1,s2=set(cells1),set(cells2)
+	if not s1 and not s2:
+		return 1.0
+	return 1.0*len(s1&s2)/len(s1|s2)
+
+def load_index(indexfile):
+	"""Read the track index, return a list of (digest,filename,cells).
+	Every line of the index is 'digest<TAB>filename<TAB>cell,cell,...'."""
+	entries=[]
+	if not exists(indexfile):
+		return entries
+	for line in open(indexfile):
+		fields=line.rstrip('\n').split('\t')
+		if len(fields) == 3:
+			digest,filename,cells=fields
+			entries.append((digest,filename,cells and cells.split(',') or []))
+	return entries
+
+def fingerprint_file(filename,tzname=None,digest=None):
+	"""Return (digest,cells) of the GPX file (or of all tracks in the archive).
+	Pass the digest if it is already known, so that the file is read once."""
+	trk=[]
+	for name,stream in iter_gpx_members(filename):
+		trk.extend(iter_gpx_segments(stream,tzname=tzname))
+	return digest or file_digest(filename),route_fingerprint(trk)
+
+def index_files(filenames,indexfile,file=sys.stdout):
+	"""Add fingerprints of the files to the index. Files with the same
+	content as already indexed ones are reported and not parsed."""
+	known=dict([(digest,name) for digest,name,cells in load_index(indexfile)])
+	f=open(indexfile,'a')
+	for filename in filenames:
+		digest=file_digest(filename)
+		if known.has_key(digest):
+			file.write('duplicate\t%s\t%s\n'%(filename,known[digest]))
+			continue
+		try:
+			digest,cells=fingerprint_file(filename,digest=digest)
+		except Exception, e: # skip broken files, but report them
+			sys.stderr.write('%s: %s\n'%(filename,e))
+			continue
+		f.write('%s\t%s\t%s\n'%(digest,filename,join(cells,',')))
+		f.flush()
+		known[digest]=filename
+		file.write('added\t%s\n'%filename)
+	f.close()
+
+def find_similar(filename,indexfile,threshold=0.5):
+	"""Find indexed routes similar to the track in filename, return
+	a list of (similarity,filename), most similar first."""
+	digest,cells=fingerprint_file(filename)
+	found=[]
+	for d,name,c in load_index(indexfile):
+		similarity=route_similarity(cells,c)
+		if d == digest:
+			similarity=1.0
+		if similarity >= threshold:
+			found.append((similarity,name))
+	found.sort(reverse=True)
+	return found
+
+def unique_files(filenames,indexfile=None):
+	"""Drop files which have the same content as some previous file,
+	or as some file in the index (if indexfile is given)."""
+	seen=set()
+	if indexfile:
+		seen=set([digest for digest,name,cells in load_index(indexfile)])
+	unique=[]
+	for filename in filenames:
+		digest=file_digest(filename)
+		if digest in seen:
+			debug('skipping duplicate %s'%filename)
+			continue
+		seen.add(digest)
+		unique.append(filename)
+	return unique
+
+def output_name(label,key,action):
+	"""Name of an output file: label without .gpx suffixes and with unsafe
+	characters replaced, followed by a short hash of key, which tells apart
+	inputs with similar labels (e.g. a.gpx and a.gpx.gz)."""
+	label=re.sub(r'\.gpx(\.(gz|bz2|xz))?$','',label,flags=re.I)
+	label=re.sub(r'[^\w.-]','_',label)
+	return '%s_%s%s'%(label,hashlib.sha1(key).hexdigest()[:8],
+			output_extensions[action])
+
+def member_key(archive,member):
+	"Checkpoint key of an archive member: full path of the archive and name."
+	return os.path.abspath(archive)+'/'+member
+
+def member_output_name(archive,member,action):
+	"Name of the output file produced for an archive member."
+	return output_name(basename(archive)+'_'+member,member_key(archive,member),
+			action)
+
+def archive_worker(job):
+	"""Parse and evaluate one archive member and write its output.
+	Return (key,error), error is None on success."""
+	key,data,action,metric,x,y,tzname,model,options,outfile=job
+	try:
+		track=Track.from_stream(InputStream(StringIO.StringIO(data)),
+			tzname=tzname,model=model,fill_ele=not options.get('dem'))
+		trk=evaluate(track,**options)
+		write_outputs(trk,[(action,metric,outfile)],x=x,y=y)
+		return key,None
+	except Exception, e:
+		return key,'%s: %s'%(e.__class__.__name__,e)
+
+def process_archives(archives,outdir,action='printtable',metric=True,
+		x=var_dist,y=var_ele,tzname=None,model=None,options={},jobs=None):
+	"""Write output of action for every GPX file in the archives to outdir.
+	Members are decompressed in this process and handed to jobs worker
+	processes. Finished members are recorded in the checkpoint file
+	in outdir, so an interrupted run resumes where it stopped. Failed
+	members and unreadable archives are recorded in a separate file and
+	are retried on resume. Return the number of failures."""
+	if not exists(outdir):
+		os.makedirs(outdir)
+	checkpoint=joinpath(outdir,checkpoint_name)
+	done=set()
+	if exists(checkpoint):
+		done=set([line.rstrip('\n') for line in open(checkpoint)])
+		debug('%d members already processed'%len(done))
+	if jobs is None:
+		jobs=cpu_count()
+	inflight=threading.Semaphore(2*max(1,jobs)) # limit members in memory
+	broken=[] # (archive,error) of archives which could not be read through
+	def iter_jobs():
+		for archive in archives:
+			try:
+				for member,stream in iter_gpx_members(archive):
+					key=member_key(archive,member)
+					if key in done:
+						continue
+					data=stream.read() # must be read before the next member
+					outfile=joinpath(outdir,
+							member_output_name(archive,member,action))
+					inflight.acquire()
+					yield key,data,action,metric,x,y,tzname,model,options,outfile
+			except Exception, e: # truncated or missing archive, go on
+				broken.append((os.path.abspath(archive),
+					'%s: %s'%(e.__class__.__name__,e)))
+	if jobs > 1:
+		pool=multiprocessing.Pool(jobs)
+		results=pool.imap_unordered(archive_worker,iter_jobs())
+	else:
+		results=itertools.imap(archive_worker,iter_jobs())
+	failed=0
+	log=open(checkpoint,'a')
+	faillog=open(joinpath(outdir,failed_name),'a')
+	def report(key,error):
+		sys.stderr.write('%s: %s\n'%(key,error))
+		faillog.write('%s\t%s\n'%(key,error))
+		faillog.flush()
+	for key,error in results:
+		inflight.release()
+		if error:
+			report(key,error)
+			failed+=1
+		else:
+			log.write(key+'\n')
+			log.flush()
+	for key,error in broken:
+		report(key,error)
+		failed+=1
+	log.close()
+	faillog.close()
+	if jobs > 1:
+		pool.close()
+		pool.join()
+	return failed
+
+class HostConnections(object):
+	"""Idle HTTP connections by host. A connection is taken by one thread
+	at a time and put back after its response has been read, so that
+	the following requests to the same host reuse it."""
+	def __init__(self,timeout=None):
+		self.timeout=timeout
+		self.idle={}
+		self.lock=threading.Lock()
+
+	def get(self,scheme,host):
+		"Return (connection,reused)."
+		with self.lock:
+			conns=self.idle.get((scheme,host))
+			if conns:
+				return conns.pop(),True
+		if scheme == 'https':
+			return httplib.HTTPSConnection(host,timeout=self.timeout),False
+		return httplib.HTTPConnection(host,timeout=self.timeout),False
+
+	def put(self,scheme,host,conn):
+		with self.lock:
+			self.idle.setdefault((scheme,host),[]).append(conn)
+
+	def close(self):
+		with self.lock:
+			for conns in self.idle.values():
+				for conn in conns:
+					conn.close()
+			self.idle={}
+
+def read_response(resp,maxsize=None):
+	"Read the body of the response, at most maxsize bytes."
+	length=resp.getheader('content-length')
+	if maxsize and length and int(length) > maxsize:
+		raise IOError('response is larger than %d bytes'%maxsize)
+	chunks,size=[],0
+	while True:
+		chunk=resp.read(chunksize)
+		if not chunk:
+			break
+		chunks.append(chunk)
+		size+=len(chunk)
+		if maxsize and size > maxsize:
+			raise IOError('response is larger than %d bytes'%maxsize)
+	return join(chunks,'')
+
+def fetch_url(url,connections,maxsize=None,redirects=5):
+	"""Download url using a connection from connections (HostConnections).
+	Follow up to redirects redirections. Raise IOError if the server
+	does not respond in time or returns an error."""
+	for i in range(redirects+1):
+		scheme,host,path,query,fragment=urlparse.urlsplit(url)
+		if scheme not in ['http','https']:
+			raise IOError('unsupported URL: %s'%url)
+		target=(path or '/')+(query and '?'+query)
+		while True:
+			conn,reused=connections.get(scheme,host)
+			try:
+				conn.request('GET',target,headers={'Accept-Encoding': 'gzip'})
+				resp=conn.getresponse()
+				break
+			except (httplib.HTTPException,socket.error), e:
+				conn.close()
+				# the server may have closed an idle connection, try a new one
+				if not reused or isinstance(e,socket.timeout):
+					raise IOError('%s: %s'%(e.__class__.__name__,e))
+		try:
+			data=read_response(resp,maxsize)
+		except:
+			conn.close()
+			raise
+		if resp.will_close:
+			conn.close()
+		else:
+			connections.put(scheme,host,conn)
+		location=resp.getheader('location')
+		if resp.status in [301,302,303,307,308] and location:
+			url=urlparse.urljoin(url,location)
+			continue
+		if resp.status != 200:
+			raise IOError('HTTP %d %s'%(resp.status,resp.reason))
+		return data
+	raise IOError('too many redirects')
+
+def fetch_urls(urls,jobs=fetch_jobs,timeout=fetch_timeout,maxsize=None):
+	"""Download urls in jobs threads. Yield (url,data,error) as soon
+	as every download finishes, error is None on success. At most jobs
+	downloaded files wait to be consumed."""
+	todo=Queue.Queue()
+	for url in urls:
+		todo.put(url)
+	done=Queue.Queue(max(1,jobs))
+	connections=HostConnections(timeout)
+	def worker():
+		while True:
+			try:
+				url=todo.get_nowait()
+			except Queue.Empty:
+				return
+			try:
+				done.put((url,fetch_url(url,connections,maxsize),None))
+			except Exception, e:
+				done.put((url,None,'%s: %s'%(e.__class__.__name__,e)))
+	threads=[threading.Thread(target=worker) for i in range(min(jobs,len(urls)))]
+	for t in threads:
+		t.daemon=True
+		t.start()
+	try:
+		for i in range(len(urls)):
+			yield done.get()
+		for t in threads:
+			t.join()
+	finally:
+		connections.close()
+
+def fetch_tracks(urls,jobs=fetch_jobs,timeout=fetch_timeout,maxsize=None,
+		tzname=None,model=None,fill_ele=True):
+	"""Download and parse GPX files. Yield (url,track,error) in the order
+	of completion. Tracks are parsed while other files are downloaded."""
+	for url,data,error in fetch_urls(urls,jobs,timeout,maxsize):
+		if error:
+			yield url,None,error
+			continue
+		try:
+			track=Track.from_stream(InputStream(StringIO.StringIO(data)),
+				tzname=tzname,model=model,fill_ele=fill_ele)
+			yield url,track,None
+		except Exception, e:
+			yield url,None,'%s: %s'%(e.__class__.__name__,e)
+
+def url_output_name(url,action):
+	"Name of the output file produced for a downloaded track."
+	scheme,host,path,query,fragment=urlparse.urlsplit(url)
+	return output_name(host+path,url,action)
+
+def process_urls(urls,outdir,action='printtable',metric=True,
+		x=var_dist,y=var_ele,tzname=None,model=None,options={},jobs=None,
+		timeout=fetch_timeout):
+	"""Download GPX files and write output of action for every file
+	to outdir. Errors are reported for each URL.
+	Return the number of failed URLs."""
+	if not exists(outdir):
+		os.makedirs(outdir)
+	failed=0
+	for url,track,error in fetch_tracks(urls,jobs or fetch_jobs,timeout,
+			tzname=tzname,model=model,fill_ele=not options.get('dem')):
+		if not error:
+			try:
+				trk=evaluate(track,**options)
+				outfile=joinpath(outdir,url_output_name(url,action))
+				write_outputs(trk,[(action,metric,outfile)],x=x,y=y)
+			except Exception, e:
+				error='%s: %s'%(e.__class__.__name__,e)
+		if error:
+			sys.stderr.write('%s: %s\n'%(url,error))
+			failed+=1
+	return failed
+
+def scan_dirs(dirs):
+	"Return {filename: (dir,mtime,size)} of all GPX files in dirs."
+	found={}
+	for d in dirs:
+		for root,subdirs,files in os.walk(d):
+			for name in files:
+				filename=joinpath(root,name)
+				if not is_gpx_name(name):
+					continue
+				try:
+					st=os.stat(filename)
+				except OSError: # removed meanwhile
+					continue
+				found[filename]=(d,st.st_mtime,st.st_size)
+	return found
+
+def watched_output_name(d,filename,action):
+	"""Name of the output file of filename found in the watched directory d:
+	the path relative to d, prefixed with the name of d."""
+	label=basename(os.path.abspath(d))+'/'+os.path.relpath(filename,d)
+	return output_name(label,os.path.abspath(filename),action)
+
+def ignore_interrupt():
+	"Leave KeyboardInterrupt to the main process."
+	signal.signal(signal.SIGINT,signal.SIG_IGN)
+
+def watch_dirs(dirs,outdir,action='printtable',metric=True,
+		x=var_dist,y=var_ele,tzname=None,model=None,options={},jobs=None,
+		interval=watch_interval,polls=None):
+	"""Poll dirs every interval seconds and write output of action for every
+	new or changed GPX file to outdir. A file is processed when its size
+	and modification time did not change since the previous poll. Files are
+	parsed by a pool of jobs worker processes started once. Digests of
+	processed files are recorded in the checkpoint file in outdir, files
+	with the same content are skipped. Failed files are recorded in a
+	separate file and are retried when they change or on restart.
+	Run forever if polls is None."""
+	if not exists(outdir):
+		os.makedirs(outdir)
+	checkpoint=joinpath(outdir,checkpoint_name)
+	done=set()
+	if exists(checkpoint):
+		done=set([line.rstrip('\n') for line in open(checkpoint)])
+	if not globals().has_key('multiprocessing'):
+		raise ImportError('multiprocessing module is required to watch directories')
+	pool=multiprocessing.Pool(jobs or cpu_count(),
+			ignore_interrupt)
+	log=open(checkpoint,'a')
+	faillog=open(joinpath(outdir,failed_name),'a')
+	previous,handled,running={},{},[]
+	def collect(wait=False):
+		for r in running[:]:
+			if wait or r.ready():
+				running.remove(r)
+				(filename,digest),error=r.get()
+				if error:
+					sys.stderr.write('%s: %s\n'%(filename,error))
+					faillog.write('%s\t%s\t%s\n'%(filename,digest,error))
+					faillog.flush()
+					done.discard(digest) # retry a copy with the same content
+				else:
+					log.write(digest+'\n')
+					log.flush()
+	try:
+		while polls is None or polls > 0:
+			current=scan_dirs(dirs)
+			for filename,stat in sorted(current.items()):
+				if previous.get(filename) != stat or handled.get(filename) == stat:
+					continue # being written or already seen
+				handled[filename]=stat
+				try:
+					data=open(filename,'rb').read()
+				except IOError:
+					continue
+				digest=hashlib.sha1(data).hexdigest()
+				if digest in done:
+					continue
+				done.add(digest)
+				outfile=joinpath(outdir,
+					watched_output_name(stat[0],filename,action))
+				job=((filename,digest),data,action,metric,x,y,tzname,model,
+						options,outfile)
+				running.append(pool.apply_async(archive_worker,[job]))
+			previous=current
+			collect()
+			if polls is not None:
+				polls-=1
+			if polls != 0:
+				sleep(interval)
+		collect(wait=True)
+		pool.close()
+	except KeyboardInterrupt:
+		pool.terminate()
+	pool.join()
+	log.close()
+	faillog.close()
+
 def main():
 	metric=True
 	xvar=var_dist
@@ -388,11 +2151,32 @@ def main():
 	imagefile=None
 	tzname=None
 	npoints=None
+	start,end=None,None
+	dem,dem_fill=None,False
+	model=None
+	outputs=[]
+	max_memory=None
+	resample=None
+	bbox,gridsize=None,(800,800)
+	jobs=None
+	indexfile=None
+	unique=False
+	uniqueindex=None
+	outdir=None
+	fetchdir=None
+	timeout=fetch_timeout
+	gap=None
+	watchdir=None
+	interval=watch_interval
 	def print_see_usage():
 		print 'see usage: ' + basename(sys.argv[0]) + ' --help'
 
-	try: opts,args=getopt.getopt(sys.argv[1:],'hgEx:y:o:t:n:',
-			['help','gprint','google','table'])
+	try: opts,args=getopt.getopt(sys.argv[1:],'hgEx:y:o:t:n:j:',
+			['help','gprint','google','table','from=','to=',
+			'dem=','dem-fill','distance-model=','out=','max-memory=',
+			'resample=','heatmap','bbox=','grid=',
+			'index=','similar=','unique','unique-in=','archive=','fetch=','timeout=','merge=',
+			'watch=','interval='])
 	except Exception, e:
 		print e
 		print_see_usage()
@@ -411,6 +2195,68 @@ def main():
 			action='googlechart'
 		if o == '--table':
 			action='printtable'
+		if o == '--heatmap':
+			action='heatmap'
+		if o == '--archive':
+			outdir=a
+		if o == '--fetch':
+			fetchdir=a
+		if o == '--timeout':
+			try:
+				timeout=parse_seconds(a)
+			except ValueError, e:
+				print e
+				print_see_usage()
+				sys.exit(EXIT_EOPTION)
+		if o == '--watch':
+			watchdir=a
+		if o == '--interval':
+			try:
+				interval=parse_seconds(a)
+			except ValueError, e:
+				print e
+				print_see_usage()
+				sys.exit(EXIT_EOPTION)
+		if o == '--merge':
+			try:
+				var,gap=parse_step(a)
+				if var != var_time:
+					raise ValueError('gap should be a time interval')
+			except ValueError, e:
+				print e
+				print_see_usage()
+				sys.exit(EXIT_EOPTION)
+		if o == '--index':
+			action,indexfile='index',a
+		if o == '--similar':
+			action,indexfile='similar',a
+		if o == '--unique':
+			unique=True
+		if o == '--unique-in':
+			unique,uniqueindex=True,a
+		if o == '--bbox':
+			try:
+				bbox=parse_bbox(a)
+			except ValueError, e:
+				print e
+				print_see_usage()
+				sys.exit(EXIT_EOPTION)
+		if o == '--grid':
+			try:
+				gridsize=parse_grid_size(a)
+			except ValueError, e:
+				print e
+				print_see_usage()
+				sys.exit(EXIT_EOPTION)
+		if o == '-j':
+			try:
+				jobs=int(a)
+				if jobs < 1:
+					raise ValueError
+			except ValueError:
+				print "number of jobs '%s' is not a positive integer"%a
+				print_see_usage()
+				sys.exit(EXIT_EOPTION)
 		if o == '-x':
 			if var_names.has_key(a):
 				xvar=var_names[a]
@@ -434,7 +2280,45 @@ def main():
 			tzname=a
 		if o == '-n':
 			npoints=int(a)
-	if len(args) > 1:
+		if o == '--from':
+			start=a
+		if o == '--to':
+			end=a
+		if o == '--dem':
+			dem=HeightTiles(a)
+		if o == '--dem-fill':
+			dem_fill=True
+		if o == '--out':
+			try:
+				outputs.append(parse_output_spec(a))
+			except ValueError, e:
+				print e
+				print_see_usage()
+				sys.exit(EXIT_EOPTION)
+		if o == '--resample':
+			try:
+				resample=parse_step(a)
+			except ValueError, e:
+				print e
+				print_see_usage()
+				sys.exit(EXIT_EOPTION)
+		if o == '--max-memory':
+			try:
+				max_memory=parse_size(a)
+			except ValueError, e:
+				print e
+				print_see_usage()
+				sys.exit(EXIT_EOPTION)
+		if o == '--distance-model':
+			if distance_models.has_key(a):
+				model=distance_models[a]
+			else:
+				print 'unknown distance model'
+				print_see_usage()
+				sys.exit(EXIT_EOPTION)
+	if len(args) > 1 and action not in ['heatmap','index','similar'] \
+			and not outdir and not fetchdir and not watchdir \
+			and gap is None:
 		print 'only one GPX file should be specified'
 		print_see_usage()
 		sys.exit(EXIT_EOPTION)
@@ -442,17 +2326,104 @@ def main():
 		print 'please provide a GPX file to process.'
 		print_see_usage()
 		sys.exit(EXIT_EOPTION)
+	# --fetch uses threads, the other parallel modes need worker processes
+	if jobs > 1 and (action == 'heatmap' or outdir or watchdir) \
+			and not globals().has_key('multiprocessing'):
+		print 'multiprocessing module is required to use -j'
+		sys.exit(EXIT_EDEPENDENCY)
+
+	try:
+		if start:
+			start=parse_time(start,tzname)
+		if end:
+			end=parse_time(end,tzname)
+	except ValueError, e:
+		print e
+		print_see_usage()
+		sys.exit(EXIT_EOPTION)
+
+	# --index reports duplicates itself, without hashing files twice
+	if unique and action != 'index' and not fetchdir and not watchdir:
+		args=unique_files(args,uniqueindex)
+	if outdir or fetchdir or watchdir:
+		if not output_extensions.has_key(action):
+			print 'only --table, --gprint and --google work with --archive, --fetch and --watch'
+			print_see_usage()
+			sys.exit(EXIT_EOPTION)
+		options={'npoints': npoints,'start': start,'end': end,'dem': dem,
+				'dem_fill': dem_fill,'resample': resample}
+		if watchdir:
+			try:
+				watch_dirs(args,watchdir,action=action,metric=metric,
+						x=xvar,y=yvar,tzname=tzname,model=model,
+						options=options,jobs=jobs,interval=interval)
+			except ImportError, e:
+				print e
+				sys.exit(EXIT_EDEPENDENCY)
+			return
+		if fetchdir:
+			failed=process_urls(args,fetchdir,action=action,metric=metric,
+					x=xvar,y=yvar,tzname=tzname,model=model,options=options,
+					jobs=jobs,timeout=timeout)
+		else:
+			failed=process_archives(args,outdir,action=action,metric=metric,
+					x=xvar,y=yvar,tzname=tzname,model=model,options=options,
+					jobs=jobs)
+		if failed:
+			print '%d files could not be processed'%failed
+			sys.exit(EXIT_EPARTIAL)
+		return
+	if action == 'index':
+		index_files(args,indexfile)
+		return
+	elif action == 'similar':
+		for filename in args:
+			for similarity,name in find_similar(filename,indexfile):
+				print '%.3f\t%s\t%s'%(similarity,filename,name)
+		return
+	elif action == 'heatmap':
+		if not bbox or not imagefile:
+			print 'heatmap needs --bbox and -o imagefile'
+			print_see_usage()
+			sys.exit(EXIT_EOPTION)
+		width,height=gridsize
+		grid,failed=heatmap(args,bbox,width,height,jobs=jobs,
+				tzname=tzname,start=start,end=end)
+		write_heatmap(grid,width,height,imagefile)
+		if failed:
+			print '%d files could not be processed'%failed
+			sys.exit(EXIT_EPARTIAL)
+		return
 
 	file=args[0]
-	trk=read_gpx_trk(file,tzname,npoints)
-	if action == 'gnuplot':
-		plot_in_gnuplot(trk,x=xvar,y=yvar,metric=metric,savefig=imagefile)
-	elif action == 'printgnuplot':
-		print_gnuplot_script(trk,x=xvar,y=yvar,metric=metric,savefig=imagefile)
-	elif action == 'printtable':
-		print_gpx_trk(trk,metric=metric)
-	elif action == 'googlechart':
-		print google_chart_url(trk,x=xvar,y=yvar,metric=metric)
+	try:
+		if gap is not None:
+			track=Track.from_files(args,gap,tzname=tzname,model=model,
+					fill_ele=not dem,max_memory=max_memory)
+		else:
+			track=Track.from_file(file,tzname=tzname,model=model,
+					fill_ele=not dem,max_memory=max_memory)
+		trk=evaluate(track,npoints,start,end,dem,dem_fill,resample)
+	except ImportError, e:
+		print e
+		sys.exit(EXIT_EDEPENDENCY)
+	try:
+		if outputs:
+			outputs=[(act,(m,metric)[m is None],fname)
+					for act,m,fname in outputs]
+			write_outputs(trk,outputs,x=xvar,y=yvar,savefig=imagefile)
+		elif action == 'gnuplot':
+			plot_in_gnuplot(trk,x=xvar,y=yvar,metric=metric,savefig=imagefile)
+		elif action == 'printgnuplot':
+			print_gnuplot_script(trk,x=xvar,y=yvar,metric=metric,
+					savefig=imagefile)
+		elif action == 'printtable':
+			print_gpx_trk(trk,metric=metric)
+		elif action == 'googlechart':
+			print google_chart_url(trk,x=xvar,y=yvar,metric=metric)
+	except ValueError, e:
+		print e
+		sys.exit(EXIT_EFORMAT)
 
 if __name__ == '__main__':
 	main()
@@ -10,10 +10,25 @@ from django.utils import simplejson as json
 
 import urllib2
 import logging
+import gzip
+import StringIO
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
 
-from gpxplot import parse_gpx_data,google_chart_url,var_dist,var_ele
+from gpxplot import Track,google_chart_url,var_dist,var_ele
+from gpxplot import polyline_profile,fetch_tracks
 
 max_gpx_size = 1048576
+max_payload_size = 65536
+max_batch_urls = 20
+batch_jobs = 4
+fetch_timeout = 10
+latency_buckets = (0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30)
+size_buckets = (1024,4096,16384,65536,262144,1048576)
+points_buckets = (10,100,1000,10000,100000,1000000)
+retry_buckets = (1,2,3,4,5,7)
 
 class GPXSizeError (Exception):
 	pass
@@ -21,19 +36,121 @@ class GPXSizeError (Exception):
 class NoAltitudeData (Exception):
     pass
 
-def plot_on_request(request):
-	"Process POST request with GPX data. Return a URL of the plot."
+class Metrics(object):
+	"""In-process registry of counters and histograms. Series are named
+	by a metric name and keyword labels. Histograms keep counts in fixed
+	buckets, so recording a value takes a lock, a dict lookup and a
+	bisection. Every instance of the application has its own registry."""
+	def __init__(self):
+		self.lock=threading.Lock()
+		self.counters={}
+		self.histograms={}
+		self.buckets={}
+
+	def inc(self,name,value=1,**labels):
+		key=(name,tuple(sorted(labels.items())))
+		with self.lock:
+			self.counters[key]=self.counters.get(key,0)+value
+
+	def observe(self,name,value,buckets=latency_buckets,**labels):
+		key=(name,tuple(sorted(labels.items())))
+		with self.lock:
+			bounds=self.buckets.setdefault(name,buckets)
+			h=self.histograms.get(key)
+			if h is None:
+				h=self.histograms[key]=[[0]*(len(bounds)+1),0.0]
+			h[0][bisect_left(bounds,value)]+=1
+			h[1]+=value
+
+	@contextmanager
+	def timer(self,name,**labels):
+		"Observe the time spent in the with block, in seconds."
+		start=time.time()
+		try:
+			yield
+		finally:
+			self.observe(name,time.time()-start,**labels)
+
+	def render(self):
+		"Return all series in Prometheus text format."
+		def series(name,labels,extra=()):
+			labels=list(labels)+list(extra)
+			if not labels:
+				return name
+			return '%s{%s}' % (name,','.join(['%s="%s"' % (k,v)
+					for k,v in labels]))
+		with self.lock:
+			counters=sorted(self.counters.items())
+			histograms=sorted([(key,(list(h[0]),h[1]))
+					for key,h in self.histograms.items()])
+		lines,typed=[],set()
+		for (name,labels),value in counters:
+			if name not in typed:
+				lines.append('# TYPE %s counter' % name)
+				typed.add(name)
+			lines.append('%s %d' % (series(name,labels),value))
+		for (name,labels),(counts,total) in histograms:
+			if name not in typed:
+				lines.append('# TYPE %s histogram' % name)
+				typed.add(name)
+			bounds=self.buckets[name]
+			n=0
+			for bound,count in zip(list(bounds)+['+Inf'],counts):
+				n+=count
+				lines.append('%s %d' % (series(name+'_bucket',labels,
+						[('le',bound)]),n))
+			lines.append('%s %r' % (series(name+'_sum',labels),total))
+			lines.append('%s %d' % (series(name+'_count',labels),n))
+		return '\n'.join(lines)+'\n'
+
+metrics=Metrics()
+
+def instrumented(f):
+	"Record latency and errors (by exception type) of a request function."
+	def wrapper(*args,**kwargs):
+		start=time.time()
+		try:
+			return f(*args,**kwargs)
+		except Exception, e:
+			metrics.inc('gpxplot_errors_total',type=e.__class__.__name__)
+			raise
+		finally:
+			metrics.observe('gpxplot_request_seconds',time.time()-start,
+					handler=f.__name__)
+	wrapper.__name__=f.__name__
+	wrapper.__doc__=f.__doc__
+	return wrapper
+
+def get_metric(request):
 	imperial=request.get('imperial')
 	if imperial == 'on':
 		metric=False
 	else:
 		metric=True
 	logging.debug('metric='+str(metric))
+	return metric
+
+def get_gpx_data(request):
+	"Fetch GPX data from gpxurl or take the submitted gpxfile."
+	with metrics.timer('gpxplot_stage_seconds',stage='fetch'):
+		gpxdata=read_gpx_data(request)
+	metrics.observe('gpxplot_input_bytes',len(gpxdata),buckets=size_buckets)
+	return gpxdata
+
+def parse_track(gpxdata):
+	"Parse GPX data, record parse time and the number of points."
+	with metrics.timer('gpxplot_stage_seconds',stage='parse'):
+		track=Track.from_string(gpxdata)
+	metrics.observe('gpxplot_input_points',len(track),buckets=points_buckets)
+	return track
+
+def read_gpx_data(request):
+	"Return GPX data of the request, downloaded or submitted."
 	try:
 		url=request.get("gpxurl")
 		if url: # fetch GPX data
 			logging.debug('fetching GPX from '+url)
-			reader=urllib2.urlopen(url)
+			reader=urllib2.urlopen(url,timeout=fetch_timeout)
 			gpxsize = int(reader.headers["Content-Length"])
 			logging.debug('gpxsize=%d' % gpxsize)
 			if gpxsize > max_gpx_size:
@@ -52,26 +169,111 @@ def plot_on_request(request):
 		raise e
 	if len(gpxdata) == 0:
 		raise Exception("There is no GPX data to plot!")
+	return gpxdata
+
+def gzip_data(data):
+	buf=StringIO.StringIO()
+	f=gzip.GzipFile(fileobj=buf,mode='wb')
+	f.write(data)
+	f.close()
+	return buf.getvalue()
+
+@instrumented
+def polyline_on_request(request,compress=False):
+	"""Process request with GPX data. Return JSON with the path and the
+	profile as encoded polylines. The track is decimated until the response
+	fits into maxbytes (after compression, if compress is True)."""
+	metric=get_metric(request)
+	maxbytes=int(request.get('maxbytes',max_payload_size))
+	gpxdata=get_gpx_data(request)
+	track=parse_track(gpxdata)
+	npoints=None
+	previous=None
+	iterations=0
+	try:
+		while True:
+			iterations+=1
+			with metrics.timer('gpxplot_stage_seconds',stage='decimate'):
+				trk=track.reduced(npoints).evaluated()
+			with metrics.timer('gpxplot_stage_seconds',stage='encode'):
+				payload=polyline_profile(trk,metric=metric)
+				data=json.dumps(payload)
+				if compress:
+					data=gzip_data(data)
+			logging.debug('npoints=%d size=%d' % (payload['npoints'],len(data)))
+			if len(data) <= maxbytes:
+				return data
+			# every segment keeps at least its first and last points
+			if payload['npoints'] <= 2 or payload['npoints'] == previous:
+				raise OverflowError("Track does not fit into %d bytes" % maxbytes)
+			previous=payload['npoints']
+			# payload size is roughly proportional to the number of points
+			npoints=min(payload['npoints']-1,
+					max(2,int(0.9*payload['npoints']*maxbytes/len(data))))
+	finally:
+		metrics.observe('gpxplot_retry_iterations',iterations,
+				buckets=retry_buckets,loop='polyline')
+
+@instrumented
+def plot_on_request(request):
+	"Process POST request with GPX data. Return a URL of the plot."
+	metric=get_metric(request)
+	gpxdata=get_gpx_data(request)
+	return plot_track(parse_track(gpxdata),metric)
+
+def plot_track(track,metric=True):
+	"Return a URL of the plot of the parsed track."
+	elevations=[e for seg in track.elevations for e in seg]
+	if not elevations or max([abs(e) for e in elevations]) < 1e-3:
+		msg = 'File does not contain altitude data ' \
+				+ 'or it is flat sea level. Nothing to plot.'
+		raise NoAltitudeData(msg)
 	# reduce number of points gradually, to fit URL length
 	npoints=700
 	url=None
-	while not url:
-		try:
-			trk=parse_gpx_data(gpxdata,npoints=npoints)
-			y=var_ele
-			max_ele=max([max([p[y] for p in s]) for s in trk if len(s) > 0])
-			min_ele=min([min([p[y] for p in s]) for s in trk if len(s) > 0])
-			if abs(max_ele) < 1e-3 and abs(min_ele) < 1e-3:
-				msg = 'File does not contain altitude data ' \
-						+ 'or it is flat sea level. Nothing to plot.'
-				raise NoAltitudeData(msg)
-			url=google_chart_url(trk,var_dist,var_ele,metric=metric)
-		except OverflowError, e:
-			npoints -= 100
-			if npoints <= 0:
-				raise e
+	iterations=0
+	try:
+		while not url:
+			iterations+=1
+			try:
+				with metrics.timer('gpxplot_stage_seconds',stage='decimate'):
+					trk=track.reduced(npoints).evaluated()
+				with metrics.timer('gpxplot_stage_seconds',stage='encode'):
+					url=google_chart_url(trk,var_dist,var_ele,metric=metric)
+			except OverflowError, e:
+				npoints -= 100
+				if npoints <= 0:
+					raise e
+	finally:
+		metrics.observe('gpxplot_retry_iterations',iterations,
+				buckets=retry_buckets,loop='plot')
 	return url
 
+@instrumented
+def batch_on_request(request):
+	"""Download all tracks given as gpxurl parameters concurrently and plot
+	them. Return JSON with a list of results, one per URL, in the order of
+	the request. A result has either a 'plot' URL or an 'error' message."""
+	metric=get_metric(request)
+	urls=request.get_all("gpxurl")
+	if len(urls) == 0:
+		raise Exception("There are no GPX URLs to plot!")
+	if len(urls) > max_batch_urls:
+		raise Exception("Too many URLs, at most %d are allowed" % max_batch_urls)
+	results={}
+	for url,track,error in fetch_tracks(urls,jobs=batch_jobs,
+			timeout=fetch_timeout,maxsize=max_gpx_size):
+		if not error:
+			try:
+				results[url]={'url':url,'plot':plot_track(track,metric)}
+				continue
+			except Exception, e:
+				error='%s: %s' % (e.__class__.__name__,e)
+		metrics.inc('gpxplot_errors_total',type=error.split(':')[0])
+		logging.error('%s: %s' % (url,error))
+		results[url]={'url':url,'error':error}
+	return json.dumps({'results':[results[url] for url in urls]})
+
 class MainPage(webapp.RequestHandler):
 	def get(self):
 		content={'title':'Visualize GPX profile online',
@@ -104,14 +306,40 @@ class MainPage(webapp.RequestHandler):
 			logging.error(e)
 		self.response.out.write(template.render('index.html',content))
 
+class MetricsHandler(webapp.RequestHandler):
+	"Return metrics of this instance in Prometheus text format."
+	def get(self):
+		self.response.headers['Content-Type']='text/plain; version=0.0.4'
+		self.response.out.write(metrics.render())
+
+class BatchHandler(webapp.RequestHandler):
+	"Return URLs of the images for several GPX files."
+	def get(self):
+		return self.post()
+	def post(self):
+		try:
+			data=batch_on_request(self.request)
+			self.response.headers['Content-Type']='application/json'
+			self.response.out.write(data)
+		except Exception, e:
+			self.response.set_status(400,message='Exception: '+unicode(e))
+
 class ApiHandler(webapp.RequestHandler):
 	"Return a URL of the image in a file."
 	def get(self):
 		return self.post()
 	def post(self):
 		try:
-			url=plot_on_request(self.request)
 			format=self.request.get("output","json")
+			if format == "polyline":
+				compress='gzip' in self.request.headers.get('Accept-Encoding','')
+				data=polyline_on_request(self.request,compress=compress)
+				self.response.headers['Content-Type']='application/json'
+				if compress:
+					self.response.headers['Content-Encoding']='gzip'
+				self.response.out.write(data)
+				return
+			url=plot_on_request(self.request)
 			if format == "json":
 				self.response.headers['Content-Type']='application/json'
 				self.response.out.write(json.dumps({'url':url}))
@@ -127,6 +355,8 @@ application = webapp.WSGIApplication(
 		  (r'/api/0.1/plot',ApiHandler),
 		  (r'/api/0.1.1/plot',ApiHandler),
 		  (r'/api/0.1.2/plot',ApiHandler),
+		  (r'/api/0.1.2/batch',BatchHandler),
+		  (r'/metrics',MetricsHandler),
 		 ], debug=True)
 
 def main():